@@ -25,12 +25,23 @@ __all__ = [
     "NeptuneHook",
 ]
 
+import gzip
+import io
 import os
+import shutil
 import warnings
+from concurrent.futures import (
+    Future,
+    ThreadPoolExecutor,
+)
 
 import detectron2
 from detectron2.checkpoint import Checkpointer
 from detectron2.engine import hooks
+from detectron2.utils.events import (
+    EventStorage,
+    get_event_storage,
+)
 
 from neptune_detectron2.impl.version import __version__
 
@@ -47,6 +58,7 @@ except ImportError:
     from neptune.new.types import File
     from neptune.new.utils import stringify_unsupported
 
+import torch
 from torch.nn import Module
 
 INTEGRATION_VERSION_KEY = "source_code/integrations/detectron2"
@@ -67,6 +79,14 @@ class NeptuneHook(hooks.HookBase):
             Expects CheckpointHook to be present.
         log_checkpoints: Whether to upload checkpoints whenever they are saved by the Trainer.
             Expects CheckpointHook to be present.
+        save_checkpoints_to_disk: Whether logged checkpoints are saved by the Trainer's checkpointer before
+            being uploaded. If False, they are serialized into an in-memory buffer instead, which is then
+            handed to the Neptune client. Note that the client still writes the buffer to its own operation
+            storage before uploading it, and the whole checkpoint is held in memory until then.
+        compress_checkpoints: Whether to gzip-compress checkpoints before uploading them.
+            Compressed checkpoints are stored with the "pth.gz" extension and need to be decompressed
+            before they can be loaded by the checkpointer. When checkpoints are saved to disk, the disk
+            briefly needs space for both the original file and its compressed copy.
 
     Example:
         import neptune
@@ -90,6 +110,8 @@ class NeptuneHook(hooks.HookBase):
         metrics_update_freq: int = 20,
         log_model: bool = False,
         log_checkpoints: bool = False,
+        save_checkpoints_to_disk: bool = True,
+        compress_checkpoints: bool = False,
     ):
         verify_type("run", run, (Run, Handler))
 
@@ -98,81 +120,216 @@ class NeptuneHook(hooks.HookBase):
         self._metrics_update_freq = metrics_update_freq
         self.log_model = log_model
         self.log_checkpoints = log_checkpoints
+        self.save_checkpoints_to_disk = save_checkpoints_to_disk
+        self.compress_checkpoints = compress_checkpoints
 
         self._verify_metrics_update_freq()
 
+        self._next_log_iter = 0
+
         if base_namespace.endswith("/"):
             base_namespace = base_namespace[:-1]
 
         self.base_handler = self._run[base_namespace]
+        self._metrics_handler = self.base_handler["metrics"]
 
         self._root_object = self._run.get_root_object() if isinstance(self._run, Handler) else self._run
 
+        self._io_pool: ThreadPoolExecutor | None = None
+        self._checkpoint_future: Future | None = None
+        self._config_and_model_future: Future | None = None
+
+        self._cfg: dict | None = None
+        self._model: Module | None = None
+        self._checkpointer: Checkpointer | None = None
+        self._event_storage: EventStorage | None = None
+
     def _verify_metrics_update_freq(self) -> None:
-        if not isinstance(self._metrics_update_freq, int):
-            raise TypeError(
-                f"metrics_update_freq should be of type int. Got {type(self._metrics_update_freq)} instead."
+        # bool is a subclass of int, so an exact type check is needed to reject True/False
+        if type(self._metrics_update_freq) is not int or self._metrics_update_freq <= 0:
+            raise ValueError(
+                f"metrics_update_freq should be an int greater than 0. Got {self._metrics_update_freq!r} instead."
             )
-        if self._metrics_update_freq <= 0:
-            raise ValueError(f"metrics_update_freq should be greater than 0. Got {self._metrics_update_freq}.")
 
     def _log_integration_version(self) -> None:
         self._root_object[INTEGRATION_VERSION_KEY] = detectron2.__version__
 
-    def _log_config(self) -> None:
-        if hasattr(self.trainer, "cfg") and isinstance(self.trainer.cfg, dict):
-            self.base_handler["config"] = stringify_unsupported(self.trainer.cfg)
-
-    def _log_model(self) -> None:
-        if hasattr(self.trainer, "model") and isinstance(self.trainer.model, Module):
-            self.base_handler["model/summary"] = str(self.trainer.model)
-
-    def _log_checkpoint(self, final: bool = False) -> None:
+    def _resolve_trainer_attributes(self) -> None:
+        cfg = getattr(self.trainer, "cfg", None)
+        model = getattr(self.trainer, "model", None)
+        checkpointer = getattr(self.trainer, "checkpointer", None)
+
+        self._cfg = cfg if isinstance(cfg, dict) else None
+        self._model = model if isinstance(model, Module) else None
+        self._checkpointer = checkpointer if isinstance(checkpointer, Checkpointer) else None
+
+        try:
+            self._event_storage = get_event_storage()
+        except AssertionError:
+            # No storage has been pushed yet; it is fetched on the first logging step instead
+            self._event_storage = None
+
+    def _log_config_and_model(self) -> None:
+        metadata = {}
+        if self._cfg is not None:
+            metadata["config"] = stringify_unsupported(self._cfg)
+        if self._model is not None:
+            metadata["model/summary"] = str(self._model)
+
+        if metadata:
+            self.base_handler.assign(metadata)
+
+    def _wait_for_config_and_model(self) -> None:
+        if self._config_and_model_future is not None:
+            future, self._config_and_model_future = self._config_and_model_future, None
+            future.result()
+
+    def _log_checkpoint(self, it: int, final: bool = False) -> None:
         if not self._can_save_checkpoint():
             warnings.warn("Checkpointer not present for the current trainer.")
             return
 
-        self.trainer.checkpointer.save(f"neptune_iter_{self.trainer.iter}")
-        neptune_model_path = "model/checkpoints/checkpoint_{}"
+        # At most one checkpoint is pending at a time, so that slow uploads don't pile up checkpoints.
+        # This also guarantees that a file is never overwritten while it is still being uploaded.
+        self._wait_for_checkpoint_upload()
 
-        neptune_model_path = neptune_model_path.format("final" if final else f"iter_{self.trainer.iter}")
+        neptune_model_path = "model/checkpoints/checkpoint_{}"
 
-        checkpoint_path = self.trainer.checkpointer.get_checkpoint_file()
+        neptune_model_path = neptune_model_path.format("final" if final else f"iter_{it}")
 
-        with open(checkpoint_path, "rb") as fp:
-            self.base_handler[neptune_model_path] = File.from_stream(fp)
-        os.remove(checkpoint_path)
+        if not self.save_checkpoints_to_disk:
+            self._checkpoint_future = self._io_pool.submit(
+                self._upload_from_buffer, self._serialize_checkpoint(it), neptune_model_path
+            )
+            return
 
-    def _log_metrics(self) -> None:
-        storage = detectron2.utils.events.get_event_storage()
-        for k, (v, _) in storage.latest_with_smoothing_hint(self._metrics_update_freq).items():
-            self.base_handler[f"metrics/{k}"].append(v)
+        self._checkpointer.save(f"neptune_iter_{it}")
+
+        checkpoint_path = self._checkpointer.get_checkpoint_file()
+
+        self._checkpoint_future = self._io_pool.submit(self._upload_and_unlink, checkpoint_path, neptune_model_path)
+
+    def _wait_for_checkpoint_upload(self) -> None:
+        if self._checkpoint_future is not None:
+            future, self._checkpoint_future = self._checkpoint_future, None
+            # Re-raises any error from the upload on the training thread
+            future.result()
+
+    def _serialize_checkpoint(self, it: int) -> io.BytesIO:
+        # Same layout as in Checkpointer.save(), so the result can be loaded by the checkpointer
+        data = {"model": self._checkpointer.model.state_dict()}
+        for key, obj in self._checkpointer.checkpointables.items():
+            data[key] = obj.state_dict()
+        data["iteration"] = it
+
+        buffer = io.BytesIO()
+        torch.save(data, buffer)
+        buffer.seek(0)
+        return buffer
+
+    def _upload_from_buffer(self, buffer: io.BytesIO, neptune_model_path: str) -> None:
+        if self.compress_checkpoints:
+            compressed = io.BytesIO()
+            _compress(buffer, compressed)
+            # Only one of the two copies of the checkpoint needs to stay in memory
+            buffer.close()
+            compressed.seek(0)
+            self.base_handler[neptune_model_path].upload(File.from_stream(compressed, extension="pth.gz"))
+        else:
+            self.base_handler[neptune_model_path].upload(File.from_stream(buffer, extension="pth"))
+
+    def _upload_and_unlink(self, checkpoint_path: str, neptune_model_path: str) -> None:
+        if self.compress_checkpoints:
+            compressed_path = f"{checkpoint_path}.gz"
+            with open(checkpoint_path, "rb") as src, open(compressed_path, "wb") as dst:
+                _compress(src, dst)
+            os.unlink(checkpoint_path)
+            checkpoint = File.from_path(compressed_path, extension="pth.gz")
+            checkpoint_path = compressed_path
+        else:
+            checkpoint = File.from_path(checkpoint_path)
+
+        # The file is uploaded as a single File field; the Neptune client itself splits large files into
+        # multipart chunks. It reads the file in the background, so it can only be removed once uploaded.
+        if self._is_offline():
+            # In offline mode the file is only read on `neptune sync`, so its content is copied into
+            # the client's operation storage instead, which makes it safe to remove the file right away
+            with open(checkpoint_path, "rb") as fp:
+                self.base_handler[neptune_model_path].upload(File.from_stream(fp, extension=checkpoint.extension))
+        else:
+            self.base_handler[neptune_model_path].upload(checkpoint, wait=True)
+        os.unlink(checkpoint_path)
+
+    def _is_offline(self) -> bool:
+        return getattr(self._root_object, "_mode", None) == "offline"
+
+    def _log_metrics(self, it: int) -> None:
+        if self._event_storage is None:
+            self._event_storage = get_event_storage()
+        latest = self._event_storage.latest_with_smoothing_hint(self._metrics_update_freq)
+        metrics = {k: v for k, (v, _) in latest.items()}
+        # The storage holds no scalars yet on some steps, e.g. on non-main processes
+        if metrics:
+            self._metrics_handler.append(metrics, step=it)
 
     def _can_save_checkpoint(self) -> bool:
-        return hasattr(self.trainer, "checkpointer") and isinstance(self.trainer.checkpointer, Checkpointer)
-
-    def _should_perform_after_step(self) -> bool:
-        return self.trainer.iter % self._metrics_update_freq == 0
+        return self._checkpointer is not None
+
+    def _should_perform_after_step(self, it: int) -> bool:
+        if it < self._next_log_iter:
+            return False
+        if it % self._metrics_update_freq != 0:
+            # Resumed from an iteration that is not a multiple of metrics_update_freq
+            self._next_log_iter = (it // self._metrics_update_freq + 1) * self._metrics_update_freq
+            return False
+        self._next_log_iter = it + self._metrics_update_freq
+        return True
 
     def before_train(self) -> None:
-        """Logs detectron2 version used, the config that the trainer uses, and the underlying model summary."""
+        """Logs detectron2 version used, the config that the trainer uses, and the underlying model summary.
+
+        The config and model summary are built in the background, so that training can start right away.
+        """
+        self._io_pool = ThreadPoolExecutor(max_workers=2)
+        self._next_log_iter = 0
+        self._resolve_trainer_attributes()
         self._log_integration_version()
-        self._log_config()
-        self._log_model()
+        self._config_and_model_future = self._io_pool.submit(self._log_config_and_model)
 
     def after_step(self) -> None:
         """Logs metrics after step and optionally the model checkpoint."""
-        if not self._should_perform_after_step():
+        it = self.trainer.iter
+        if not self._should_perform_after_step(it):
             return
 
-        self._log_metrics()
+        self._log_metrics(it)
 
         if self.log_checkpoints:
-            self._log_checkpoint()
+            self._log_checkpoint(it)
 
     def after_train(self) -> None:
-        """Optionally saves the final model checkpoint. Syncs the run."""
-        if self.log_model:
-            self._log_checkpoint(final=True)
+        """Optionally saves the final model checkpoint. Waits for pending uploads and syncs the run."""
+        # The trainer calls after_train even if before_train was never reached, e.g. when another hook's
+        # before_train failed. In that case nothing was resolved or scheduled, so there is nothing to wait for.
+        if self._io_pool is None:
+            self._root_object.sync()
+            return
+
+        try:
+            if self.log_model:
+                self._log_checkpoint(self.trainer.iter, final=True)
+
+            self._wait_for_checkpoint_upload()
+            self._wait_for_config_and_model()
+        finally:
+            self._io_pool.shutdown(wait=True)
+            self._io_pool = None
+            self._root_object.sync()
+
 
-        self._root_object.sync()
+def _compress(src: io.IOBase, dst: io.IOBase) -> None:
+    # The lowest compression level is much faster than the default and already shrinks weights considerably.
+    # Copying in chunks keeps memory usage flat, while writing the whole content at once would make zlib
+    # build the full compressed output in memory.
+    with gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=1) as gz:
+        shutil.copyfileobj(src, gz)
@@ -3,6 +3,11 @@ from detectron2 import model_zoo
 from detectron2.config import get_cfg
 from detectron2.engine import DefaultTrainer
 
+try:
+    from neptune import init_run
+except ImportError:
+    from neptune.new import init_run
+
 
 @pytest.fixture(scope="session")
 def cfg():
@@ -27,3 +32,10 @@ def cfg():
 @pytest.fixture(scope="session")
 def trainer(cfg):
     yield DefaultTrainer(cfg)
+
+
+@pytest.fixture
+def debug_run():
+    run = init_run(mode="debug")
+    yield run
+    run.stop()
@@ -0,0 +1,141 @@
+import gzip
+import io
+import os
+import warnings
+from unittest.mock import MagicMock
+
+import pytest
+import torch
+from detectron2.checkpoint import Checkpointer
+
+from src.neptune_detectron2 import NeptuneHook
+
+
+def _mock_trainer(checkpoint_dir, iteration=5):
+    def save(name):
+        torch.save({"iteration": iteration}, checkpoint_dir / f"{name}.pth")
+        checkpointer.get_checkpoint_file.return_value = str(checkpoint_dir / f"{name}.pth")
+
+    model = torch.nn.Linear(2, 2)
+
+    checkpointer = MagicMock(spec=Checkpointer)
+    checkpointer.save.side_effect = save
+    checkpointer.model = model
+    checkpointer.checkpointables = {}
+
+    return MagicMock(
+        cfg={"SOLVER": {"BASE_LR": 0.1}},
+        model=model,
+        checkpointer=checkpointer,
+        iter=iteration,
+    )
+
+
+def _uploaded_file(hook, neptune_model_path):
+    hook.base_handler.__getitem__.assert_any_call(neptune_model_path)
+    return hook.base_handler.__getitem__.return_value.upload.call_args[0][0]
+
+
+@pytest.mark.parametrize("metrics_update_freq", [True, False, 0, -1, "5", 5.0])
+def test_invalid_metrics_update_freq(debug_run, metrics_update_freq):
+    with pytest.raises(ValueError):
+        NeptuneHook(run=debug_run, metrics_update_freq=metrics_update_freq)
+
+
+def test_should_perform_after_step(debug_run):
+    hook = NeptuneHook(run=debug_run, metrics_update_freq=10)
+
+    assert [it for it in range(0, 25) if hook._should_perform_after_step(it)] == [0, 10, 20]
+
+
+def test_should_perform_after_step_after_resume(debug_run):
+    hook = NeptuneHook(run=debug_run, metrics_update_freq=10)
+
+    assert [it for it in range(57, 81) if hook._should_perform_after_step(it)] == [60, 70, 80]
+
+
+def test_should_perform_after_step_is_reset_for_new_training(debug_run):
+    hook = NeptuneHook(run=debug_run, metrics_update_freq=10)
+    hook.trainer = MagicMock()
+    assert hook._should_perform_after_step(40)
+
+    hook.before_train()
+    hook.after_train()
+
+    assert hook._should_perform_after_step(0)
+
+
+def test_log_final_checkpoint(debug_run, tmp_path):
+    hook = NeptuneHook(run=debug_run, log_model=True)
+    hook.trainer = _mock_trainer(tmp_path)
+
+    hook.before_train()
+    hook.after_train()
+
+    hook.trainer.checkpointer.save.assert_called_once_with("neptune_iter_5")
+    assert debug_run.exists("training/model/checkpoints/checkpoint_final")
+    assert debug_run.exists("training/config/SOLVER/BASE_LR")
+    assert isinstance(debug_run["training/model/summary"].fetch(), str)
+    assert os.listdir(tmp_path) == []
+
+
+def test_after_train_without_before_train(debug_run):
+    hook = NeptuneHook(run=debug_run, log_model=True)
+    hook.trainer = MagicMock()
+
+    with warnings.catch_warnings():
+        warnings.filterwarnings("error", message="Checkpointer not present")
+        hook.after_train()
+
+    assert not debug_run.exists("training/model/checkpoints/checkpoint_final")
+
+
+def test_log_final_checkpoint_from_memory(debug_run, tmp_path):
+    hook = NeptuneHook(run=debug_run, log_model=True, save_checkpoints_to_disk=False)
+    hook.base_handler = MagicMock()
+    hook.trainer = _mock_trainer(tmp_path)
+
+    hook.before_train()
+    hook.after_train()
+
+    file = _uploaded_file(hook, "model/checkpoints/checkpoint_final")
+    assert file.extension == "pth"
+
+    checkpoint = torch.load(io.BytesIO(file.content))
+    assert checkpoint["iteration"] == 5
+    assert torch.equal(checkpoint["model"]["weight"], hook.trainer.model.state_dict()["weight"])
+    hook.trainer.checkpointer.save.assert_not_called()
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize("save_checkpoints_to_disk", [True, False])
+def test_log_compressed_checkpoint(debug_run, tmp_path, save_checkpoints_to_disk):
+    hook = NeptuneHook(
+        run=debug_run,
+        log_model=True,
+        save_checkpoints_to_disk=save_checkpoints_to_disk,
+        compress_checkpoints=True,
+    )
+    hook.base_handler = MagicMock()
+    hook.trainer = _mock_trainer(tmp_path)
+
+    uploaded = {}
+
+    def upload(file, wait=False):
+        # Checkpoints saved on disk only have to exist until the upload call returns
+        uploaded["extension"] = file.extension
+        if save_checkpoints_to_disk:
+            with open(file.path, "rb") as fp:
+                uploaded["content"] = fp.read()
+        else:
+            uploaded["content"] = file.content
+
+    hook.base_handler.__getitem__.return_value.upload.side_effect = upload
+
+    hook.before_train()
+    hook.after_train()
+
+    _uploaded_file(hook, "model/checkpoints/checkpoint_final")
+    assert uploaded["extension"] == "pth.gz"
+    assert torch.load(io.BytesIO(gzip.decompress(uploaded["content"])))["iteration"] == 5
+    assert os.listdir(tmp_path) == []